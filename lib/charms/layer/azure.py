@@ -1,15 +1,15 @@
+import hashlib
 import json
 import os
 import re
 import subprocess
-from base64 import b64decode
+import threading
+import time
 from enum import Enum
-from math import ceil, floor
+from functools import lru_cache, wraps
 from pathlib import Path
-from urllib.error import HTTPError
-from urllib.request import urlopen, Request
-
-import yaml
+from urllib.parse import quote, urlencode, urlsplit
+from uuid import NAMESPACE_URL, uuid5
 
 from charmhelpers.core import hookenv
 from charmhelpers.core.unitdata import kv
@@ -27,6 +27,35 @@ SUPPORTED_LB_HC_PROTOS = ["http", "https", "tcp"]
 LB_NAME = "integrator-{request.id}"
 LB_POOL_NAME = "integrator-{request.id}-pool"
 LB_PUBLIC_IP_NAME = "integrator-{request.id}-public-ip"
+ARM_URL = "https://management.azure.com"
+ARM_SCOPE = "https://management.azure.com/.default"
+ARM_TOKEN_URL = "https://login.microsoftonline.com/{}/oauth2/v2.0/token"
+COMPUTE_API_VERSION = "2023-03-01"
+AUTHORIZATION_API_VERSION = "2022-04-01"
+RESOURCES_API_VERSION = "2021-04-01"
+BATCH_API_VERSION = "2020-06-01"
+# the ARM batch endpoint accepts at most this many requests at once
+MAX_BATCH_SIZE = 20
+# concurrent requests to use if the batch endpoint is unavailable
+MAX_PARALLEL_REQUESTS = 4
+# maximum number of seconds to wait for an asynchronous ARM operation
+ARM_POLL_TIMEOUT = 5 * 60
+# minimum number of seconds between checks for removed VMs
+CLEANUP_INTERVAL = 60 * 60
+
+# errors from logging in which may indicate that the cached tenant is wrong
+TENANT_LOGIN_ERRORS = ("AADSTS70002", "AADSTS90002", "invalid_client")
+_TENANT_URL_TMPL = (
+    "https://management.azure.com/subscriptions/{}?api-version=2018-03-01-01.6.1"
+)
+_AUTH_URI_RE = re.compile(r'authorization_uri="[^"]*/([^/"]*)"')
+
+# idle keep-alive HTTPS connections, by host, for reuse within the hook
+_connections = {}
+_connections_lock = threading.Lock()
+
+# ARM operations queued during the hook, to be issued together by flush()
+_pending_ops = []
 
 
 class StandardRole(Enum):
@@ -78,27 +107,30 @@ def get_credentials():
     # try to use Juju's trust feature
     try:
         result = subprocess.run(
-            ["credential-get"],
+            ["credential-get", "--format=json"],
             check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            universal_newlines=True,
         )
-        creds = yaml.load(result.stdout.decode("utf8"))
+        creds = _parse_credential_output(result.stdout)
         creds_data = creds["credential"]["attributes"]
-        login_cli(creds_data)
+        _ensure_login(creds_data)
         return True
     except FileNotFoundError:
         pass  # juju trust not available
     except subprocess.CalledProcessError as e:
-        if "permission denied" not in e.stderr.decode("utf8"):
+        if "permission denied" not in e.stderr:
             raise
         no_creds_msg = "missing credentials access; grant with: juju trust"
 
     # try credentials config
     if config["credentials"]:
         try:
+            from base64 import b64decode
+
             creds_data = b64decode(config["credentials"]).decode("utf8")
-            login_cli(json.loads(creds_data))
+            _ensure_login(json.loads(creds_data))
             return True
         except Exception as ex:
             msg = "invalid value for credentials config"
@@ -111,6 +143,45 @@ def get_credentials():
     return False
 
 
+def _parse_credential_output(output):
+    """
+    Parse the output of credential-get.
+
+    JSON is requested, since it's much faster to parse, but fall back to YAML,
+    which is the hook tool's default format.
+    """
+    try:
+        return json.loads(output)
+    except ValueError:
+        import yaml
+
+        return yaml.safe_load(output)
+
+
+def _creds_hash(creds_data):
+    """
+    Get a hash identifying the given credentials, without storing them.
+    """
+    fields = ("application-id", "application-password", "subscription-id")
+    key = "\0".join(creds_data[field] for field in fields)
+    return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+
+def _ensure_login(creds_data):
+    """
+    Log in with the credentials, unless the previous login used the same
+    credentials and they can still get an ARM API token.
+    """
+    if kv().get("charm.azure.creds-hash") == _creds_hash(creds_data):
+        try:
+            _get_arm_token()
+            log("Credentials unchanged; reusing existing login")
+            return
+        except AzureError as e:
+            log_debug("Unable to reuse existing login: {}", e)
+    login_cli(creds_data)
+
+
 def login_cli(creds_data):
     """
     Use the credentials to authenticate the Azure CLI.
@@ -119,11 +190,12 @@ def login_cli(creds_data):
     app_pass = creds_data["application-password"]
     sub_id = creds_data["subscription-id"]
     tenant_id = _get_tenant_id(sub_id)
-    try:
-        log("Forcing logout of Azure CLI")
-        _azure("logout")
-    except AzureError:
-        pass
+    if kv().get("charm.azure.creds-hash"):
+        try:
+            log("Logging out previous credentials from Azure CLI")
+            _azure("logout", parse_json=False)
+        except AzureError:
+            pass
     try:
         log("Logging in to Azure CLI")
         _azure(
@@ -135,33 +207,80 @@ def login_cli(creds_data):
             app_pass,
             "-t",
             tenant_id,
+            parse_json=False,
         )
         # cache the subscription ID for use in roles
         kv().set("charm.azure.sub-id", sub_id)
+        # cache the credentials for getting ARM API tokens in later hooks
+        kv().set(
+            "charm.azure.creds",
+            {
+                "application-id": app_id,
+                "application-password": app_pass,
+                "tenant-id": tenant_id,
+            },
+        )
+        kv().unset("charm.azure.arm-token")
+        kv().set("charm.azure.creds-hash", _creds_hash(creds_data))
     except AzureError as e:
+        if any(err in e.args[0] for err in TENANT_LOGIN_ERRORS):
+            _get_tenant_id.invalidate(sub_id)
         # redact the credential info from the exception message
-        stderr = re.sub(app_id, "<app-id>", e.args[0])
-        stderr = re.sub(app_pass, "<app-pass>", stderr)
-        stderr = re.sub(tenant_id, "<tenant-id>", stderr)
+        redact = _redactor(
+            {app_id: "<app-id>", app_pass: "<app-pass>", tenant_id: "<tenant-id>"}
+        )
+        stderr = redact(e.args[0])
         # from None suppresses the previous exception from the stack trace
         raise AzureError(stderr) from None
 
 
+def _redactor(redactions):
+    """
+    Create a function which replaces each of the keys of the given mapping
+    in a string with its value, in a single pass.
+    """
+    redactions = {secret: value for secret, value in redactions.items() if secret}
+    if not redactions:
+        return lambda s: s
+    # longest first, so that a secret which contains another is fully redacted
+    secrets = sorted(redactions, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(secret) for secret in secrets))
+    return lambda s: pattern.sub(lambda m: redactions[m.group(0)], s)
+
+
 def ensure_msi(request):
+    # record where the VM is, so that cleanup() can check if it still exists
+    vm_resource_ids = kv().get("charm.azure.vm-resource-ids", {})
+    if vm_resource_ids.get(request.vm_id) != _vm_resource_id(request):
+        vm_resource_ids[request.vm_id] = _vm_resource_id(request)
+        kv().set("charm.azure.vm-resource-ids", vm_resource_ids)
     msi = _get_msi(request.vm_id)
     if not msi:
-        log("Enabling Managed Service Identity")
-        result = _azure(
-            "vm",
-            "identity",
-            "assign",
-            "--name",
-            request.vm_name,
-            "--resource-group",
-            request.resource_group,
-        )
+        # the VM may already have an identity that just isn't cached locally
+        vm = _get_vm(request.vm_id, _vm_path(request))
+        identity = vm.get("identity") or {}
+        msi = identity.get("principalId")
+        if not msi:
+            log("Enabling Managed Service Identity")
+            identity_types = {
+                t.strip() for t in identity.get("type", "None").split(",")
+            } - {"None"}
+            # preserve any user-assigned identities already on the VM
+            identity_types.add("SystemAssigned")
+            new_identity = {"type": ", ".join(sorted(identity_types))}
+            if identity.get("userAssignedIdentities"):
+                new_identity["userAssignedIdentities"] = {
+                    uai: {} for uai in identity["userAssignedIdentities"]
+                }
+            _, headers, result = _arm_send(
+                "PATCH", ARM_URL + _vm_path(request), {"identity": new_identity}
+            )
+            msi = result["identity"]["principalId"]
+            # the VM can't be updated again, and the identity can't be used,
+            # until this has finished
+            _wait_for_operation(headers)
         vm_identities = kv().get("charm.azure.vm-identities", {})
-        msi = vm_identities[request.vm_id] = result["systemAssignedIdentity"]
+        vm_identities[request.vm_id] = msi
         kv().set("charm.azure.vm-identities", vm_identities)
     log("Instance MSI is: {}", msi)
 
@@ -172,7 +291,7 @@ def send_additional_metadata(request):
     available from the metadata server.
     """
     run_config = hookenv.config() or {}
-    res_grp = _azure("group", "show", "--name", request.resource_group)
+    res_grp = _get_group(request.resource_group)
     # hard-code most of these because with Juju, they're always the same
     # and the queries required to look them up are a PITA
     request.send_additional_metadata(
@@ -197,19 +316,11 @@ def tag_instance(request):
     Tag the given instance with the given tags.
     """
     log("Tagging instance with: {}", request.instance_tags)
-    _azure(
-        "vm",
-        "update",
-        "--name",
-        request.vm_name,
-        "--resource-group",
-        request.resource_group,
-        "--set",
-        *[
-            "tags.{}={}".format(tag, value)
-            for tag, value in request.instance_tags.items()
-        ],
-    )
+    # a PATCH replaces the whole tags map, so merge with the existing tags
+    vm = _get_vm(request.vm_id, _vm_path(request))
+    tags = dict(vm.get("tags") or {})
+    tags.update(request.instance_tags)
+    _pending_ops.append(("PATCH", _vm_path(request), {"tags": tags}))
 
 
 def enable_instance_inspection(request):
@@ -322,7 +433,7 @@ def create_loadbalancer(request):
             config["subnetName"],
         ]
 
-    _azure("network", *lb_create_args)
+    _azure("network", *lb_create_args, parse_json=False)
 
     backend_args = []
     for i, backend in enumerate(request.backends):
@@ -345,6 +456,7 @@ def create_loadbalancer(request):
         "--vnet",
         config["vnetName"],
         *backend_args,
+        parse_json=False,
     )
 
     for front, back in request.port_mapping.items():
@@ -365,6 +477,7 @@ def create_loadbalancer(request):
             back,
             "--protocol",
             request.protocol.value.capitalize(),
+            parse_json=False,
         )
 
     for i, health_check in enumerate(request.health_checks):
@@ -391,7 +504,7 @@ def create_loadbalancer(request):
         if health_check.path:
             lb_probe_create_args += ["--path", health_check.path]
 
-        _azure("network", *lb_probe_create_args)
+        _azure("network", *lb_probe_create_args, parse_json=False)
 
     if request.public:
         nsg_priorities = _azure(
@@ -444,7 +557,8 @@ def create_loadbalancer(request):
                             "--access",
                             "allow",
                             "--priority",
-                            priority
+                            priority,
+                            parse_json=False,
                         )
                         break
                     except SecurityRuleConflictAzureError:
@@ -503,6 +617,7 @@ def remove_loadbalancer(request):
             lb_name,
             "--resource-group",
             resource_group,
+            parse_json=False,
         )
     except DoesNotExistAzureError:
         pass
@@ -518,6 +633,7 @@ def remove_loadbalancer(request):
             LB_PUBLIC_IP_NAME.format(request=request),
             "--resource-group",
             resource_group,
+            parse_json=False,
         )
     except DoesNotExistAzureError:
         pass
@@ -548,7 +664,8 @@ def remove_loadbalancer(request):
                 "--nsg-name",
                 config["vnetSecurityGroup"],
                 "--name",
-                nsg_rule
+                nsg_rule,
+                parse_json=False,
             )
         except DoesNotExistAzureError:
             pass
@@ -612,48 +729,96 @@ def enable_object_storage_management(request):
     _assign_role(request, StandardRole.OBJECT_STORE_MANAGER)
 
 
+def flush():
+    """
+    Issue all ARM operations queued during this hook as batch requests.
+    """
+    if not _pending_ops:
+        return
+    ops = list(_pending_ops)
+    _pending_ops.clear()
+    log("Issuing {} queued ARM operations", len(ops))
+    try:
+        responses = _arm_batch(ops)
+    except AzureError as e:
+        log_err("Batch request failed, sending individually: {}", e)
+        responses = _arm_parallel(ops)
+    errors = []
+    for (method, path, _), response in zip(ops, responses):
+        status_code = response["httpStatusCode"]
+        if status_code < 400:
+            continue
+        error = AzureError.from_response(status_code, response.get("content"))
+        # the operations are all idempotent, so something already existing
+        # means that a previous attempt succeeded
+        if isinstance(error, AlreadyExistsAzureError):
+            continue
+        if method == "DELETE" and isinstance(error, DoesNotExistAzureError):
+            continue
+        errors.append("{} {}: {}".format(method, path, error))
+    if errors:
+        raise AzureError("\n".join(errors))
+
+
 def cleanup():
     """
-    Perform cleanup.
+    Forget the identities of VMs which no longer exist and remove the role
+    assignments which were made for them.
+
+    Since this has to list all of the VMs in the subscription, it is only
+    done at most once per CLEANUP_INTERVAL. The credentials may not be able
+    to see every VM, so each VM missing from the list is also checked
+    directly, and only cleaned up if that confirms it is gone.
     """
-    pass
+    vm_identities = kv().get("charm.azure.vm-identities", {})
+    if not vm_identities:
+        return
+    last_cleanup = kv().get("charm.azure.last-cleanup", 0)
+    if time.time() < last_cleanup + CLEANUP_INTERVAL:
+        return
+    kv().set("charm.azure.last-cleanup", time.time())
+    try:
+        unlisted_vms = set(vm_identities) - _list_vm_ids()
+        removed_vms = [vm_id for vm_id in unlisted_vms if _vm_removed(vm_id)]
+        if not removed_vms:
+            return
+        role_assignments = kv().get("charm.azure.role-assignments", {})
+        vm_resource_ids = kv().get("charm.azure.vm-resource-ids", {})
+        for vm_id in removed_vms:
+            log("Cleaning up after removed VM {}", vm_id)
+            del vm_identities[vm_id]
+            del vm_resource_ids[vm_id]
+            for assignment_id in role_assignments.pop(vm_id, []):
+                _pending_ops.append(
+                    (
+                        "DELETE",
+                        "{}?api-version={}".format(
+                            assignment_id, AUTHORIZATION_API_VERSION
+                        ),
+                        None,
+                    )
+                )
+        flush()
+    except AzureError as e:
+        # this will be tried again later, so shouldn't fail the hook
+        log_err("Error cleaning up after removed VMs: {}", e)
+        return
+    kv().set("charm.azure.vm-identities", vm_identities)
+    kv().set("charm.azure.role-assignments", role_assignments)
+    kv().set("charm.azure.vm-resource-ids", vm_resource_ids)
 
 
 def update_roles():
     """
     Update all custom roles based on current definition file.
+
+    Roles whose definition file hasn't changed since they were last loaded
+    are left as they are.
     """
-    sub_id = kv().get("charm.azure.sub-id")
-    known_roles = {}
     for role_file in Path("files/roles/").glob("*.json"):
-        role_name = role_file.stem
-        role_data = json.loads(role_file.read_text())
-        role_fullname = role_data["Name"].format(sub_id)
-        scope = role_data["AssignableScopes"][0].format(sub_id)
-        role_data["Name"] = role_fullname
-        role_data["AssignableScopes"][0] = scope
-        try:
-            # assume already exists, so try updating first
-            _azure(
-                "role",
-                "definition",
-                "update",
-                "--role-definition",
-                json.dumps(role_data),
-            )
-            log("Updated existing role {}", role_fullname)
-        except DoesNotExistAzureError:
-            # doesn't exist, so create
-            _azure(
-                "role",
-                "definition",
-                "create",
-                "--role-definition",
-                json.dumps(role_data),
-            )
-            log("Created new role {}", role_fullname)
-        known_roles[role_name] = role_fullname
-    kv().set("charm.azure.roles", known_roles)
+        _get_role(role_file.stem)
+    # superseded by the charm.azure.cache.role-ids namespace
+    kv().unset("charm.azure.roles")
 
 
 # Internal helpers
@@ -661,7 +826,8 @@ def update_roles():
 
 class AzureError(Exception):
     """
-    Exception class representing an error returned from the azure-cli tool.
+    Exception class representing an error returned from the azure-cli tool
+    or the Azure Resource Manager API.
     """
 
     @classmethod
@@ -682,6 +848,21 @@ class AzureError(Exception):
             return SecurityRuleConflictAzureError(message)
         return AzureError(message)
 
+    @classmethod
+    def from_response(cls, status_code, body):
+        """
+        Factory method to create an error from a failed ARM API response,
+        given its status code and parsed body.
+        """
+        try:
+            error = body["error"]
+            message = "{}: {}".format(error["code"], error["message"])
+        except (KeyError, TypeError):
+            message = str(body or "HTTP {}".format(status_code))
+        if status_code == 404:
+            return DoesNotExistAzureError(message)
+        return cls.get(message)
+
 
 class AlreadyExistsAzureError(AzureError):
     """
@@ -706,38 +887,441 @@ class SecurityRuleConflictAzureError(AzureError):
     pass
 
 
-def _elide(s, max_len, ellipsis="..."):
-    """
-    Elide s in the middle to ensure it is under max_len.
-
-    That is, shorten the string, inserting an ellipsis where the removed
-    characters were to show that they've been removed.
-    """
-    if len(s) > max_len:
-        hl = (max_len - len(ellipsis)) / 2
-        headl, taill = floor(hl), ceil(hl)
-        s = s[:headl] + ellipsis + s[-taill:]
-    return s
-
-
-def _azure(cmd, *args, return_stderr=False):
+def _azure(cmd, *args, return_stderr=False, parse_json=True):
     """
     Call the azure-cli tool.
+
+    The output is parsed as JSON, unless parse_json is False, in which case
+    it is returned as a string.
     """
     cmd = ["az", cmd]
     cmd.extend(str(arg) for arg in args)
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout = result.stdout.decode("utf8").strip()
-    stderr = result.stderr.decode("utf8").strip()
+    result = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    stdout = result.stdout.strip()
+    stderr = result.stderr.strip()
     if result.returncode != 0:
         raise AzureError.get(stderr)
     if return_stderr:
         return stderr
-    if stdout:
+    if stdout and parse_json:
         stdout = json.loads(stdout)
     return stdout
 
 
+def _get_arm_token():
+    """
+    Get a bearer token for the ARM API, reusing the cached one while valid.
+    """
+    token = kv().get("charm.azure.arm-token")
+    if token and token["exp"] > time.time() + 60:
+        return token["token"]
+    creds = kv().get("charm.azure.creds")
+    if not creds:
+        raise AzureError("no credentials available for the ARM API")
+    data = urlencode(
+        {
+            "grant_type": "client_credentials",
+            "client_id": creds["application-id"],
+            "client_secret": creds["application-password"],
+            "scope": ARM_SCOPE,
+        }
+    ).encode("utf8")
+    status_code, _, content = _https_request(
+        "POST",
+        ARM_TOKEN_URL.format(creds["tenant-id"]),
+        data,
+        {"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    result = _parse_body(content)
+    if status_code >= 400:
+        try:
+            message = result["error_description"]
+        except (KeyError, TypeError):
+            message = "HTTP {}".format(status_code)
+        raise AzureError("Unable to get ARM token: {}".format(message))
+    token = {
+        "token": result["access_token"],
+        "exp": time.time() + int(result["expires_in"]),
+    }
+    kv().set("charm.azure.arm-token", token)
+    return token["token"]
+
+
+def _https_request(method, url, data=None, headers=None):
+    """
+    Make an HTTPS request, reusing an idle connection to the host if there
+    is one, so that successive requests avoid a new TLS handshake.
+
+    Returns the response status, headers, and raw body.
+    """
+    # only imported when needed, since it pulls in ssl, email, etc
+    import http.client
+
+    parts = urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    headers = dict(headers or {}, Connection="keep-alive")
+    with _connections_lock:
+        idle = _connections.setdefault(parts.netloc, [])
+        conn = idle.pop() if idle else None
+    reused = conn is not None
+    if not reused:
+        conn = http.client.HTTPSConnection(parts.netloc, timeout=60)
+    try:
+        conn.request(method, path, body=data, headers=headers)
+        response = conn.getresponse()
+        content = response.read()
+    except (http.client.HTTPException, OSError) as e:
+        conn.close()
+        if reused:
+            # the server may have closed the idle connection, so try again
+            return _https_request(method, url, data, headers)
+        raise AzureError(
+            "Error connecting to {}: {}".format(parts.netloc, e)
+        ) from e
+    if response.will_close:
+        conn.close()
+    else:
+        with _connections_lock:
+            _connections[parts.netloc].append(conn)
+    return response.status, response.headers, content
+
+
+def _parse_body(content):
+    """
+    Parse an ARM API response body, which is usually but not always JSON.
+    """
+    content = content.decode("utf8").strip()
+    if not content:
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        return content
+
+
+def _arm_send(method, url, body=None, check=True, token=None):
+    """
+    Send a request to the given ARM API URL.
+
+    Returns the response status, headers, and parsed body. If check is True,
+    an error response is raised as an AzureError. If no token is given, the
+    current one is used, which requires access to unitdata.
+    """
+    headers = {"Authorization": "Bearer " + (token or _get_arm_token())}
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode("utf8")
+        headers["Content-Type"] = "application/json"
+    status_code, headers, content = _https_request(method, url, data, headers)
+    if check and status_code >= 400:
+        raise AzureError.from_response(status_code, _parse_body(content))
+    return status_code, headers, _parse_body(content)
+
+
+def _arm_request(method, path, body=None):
+    """
+    Make a request to the Azure Resource Manager API.
+
+    The path is relative to the management endpoint and must include the
+    api-version query parameter. Returns the parsed response body, if any.
+    """
+    return _arm_send(method, ARM_URL + path, body)[2]
+
+
+def _retry_after(headers):
+    """
+    Get the number of seconds to wait before polling an asynchronous ARM
+    operation again.
+    """
+    try:
+        return min(int(headers.get("Retry-After", 1)), 30)
+    except ValueError:
+        return 1
+
+
+def _wait_for_operation(headers):
+    """
+    Wait for a long-running ARM operation to finish, given the headers of the
+    response to the request which started it.
+    """
+    url = headers.get("Azure-AsyncOperation")
+    if not url:
+        return
+    deadline = time.time() + ARM_POLL_TIMEOUT
+    while True:
+        time.sleep(_retry_after(headers))
+        status_code, headers, result = _arm_send("GET", url)
+        op_status = result.get("status") if isinstance(result, dict) else None
+        if op_status == "Succeeded":
+            return
+        if op_status in ("Failed", "Canceled"):
+            raise AzureError.from_response(status_code, result)
+        if time.time() > deadline:
+            raise AzureError("Timed out waiting for operation {}".format(url))
+
+
+def _arm_batch(subrequests):
+    """
+    Issue multiple ARM API requests using the batch endpoint.
+
+    Takes a list of (method, path, body) tuples and returns the list of
+    responses, in the same order, each of which has the httpStatusCode and
+    the parsed content of the response to that request.
+    """
+    responses = {}
+    for i in range(0, len(subrequests), MAX_BATCH_SIZE):
+        batch = []
+        for j, (method, path, body) in enumerate(subrequests[i:i + MAX_BATCH_SIZE]):
+            subrequest = {"name": str(i + j), "httpMethod": method, "relativeUrl": path}
+            if body is not None:
+                subrequest["content"] = body
+            batch.append(subrequest)
+        status_code, headers, result = _arm_send(
+            "POST",
+            "{}/batch?api-version={}".format(ARM_URL, BATCH_API_VERSION),
+            {"requests": batch},
+        )
+        # the batch may be processed asynchronously, in which case the
+        # results need to be polled for until they're ready
+        deadline = time.time() + ARM_POLL_TIMEOUT
+        while status_code == 202:
+            if "Location" not in headers:
+                raise AzureError("Batch request accepted without a Location")
+            if time.time() > deadline:
+                raise AzureError("Timed out waiting for batch request")
+            time.sleep(_retry_after(headers))
+            status_code, headers, result = _arm_send("GET", headers["Location"])
+        try:
+            for response in result["responses"]:
+                responses[response["name"]] = response
+        except (KeyError, TypeError):
+            raise AzureError("Invalid batch response: {}".format(result)) from None
+    missing = [str(i) for i in range(len(subrequests)) if str(i) not in responses]
+    if missing:
+        raise AzureError(
+            "Batch response missing requests: {}".format(", ".join(missing))
+        )
+    return [responses[str(i)] for i in range(len(subrequests))]
+
+
+def _arm_parallel(subrequests):
+    """
+    Issue multiple ARM API requests concurrently, for when the batch endpoint
+    can't be used.
+
+    Takes and returns the same as _arm_batch.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the worker threads can't access unitdata, so get the token up front
+    token = _get_arm_token()
+
+    def send(subrequest):
+        method, path, body = subrequest
+        status_code, _, content = _arm_send(
+            method, ARM_URL + path, body, check=False, token=token
+        )
+        return {"httpStatusCode": status_code, "content": content}
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+        return list(executor.map(send, subrequests))
+
+
+def _vm_resource_id(request):
+    """
+    Get the ARM resource ID of the requesting VM.
+    """
+    return (
+        "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute"
+        "/virtualMachines/{}".format(
+            kv().get("charm.azure.sub-id"),
+            request.resource_group,
+            request.vm_name,
+        )
+    )
+
+
+def _vm_path(request):
+    """
+    Get the ARM API path for the requesting VM.
+    """
+    return "{}?api-version={}".format(_vm_resource_id(request), COMPUTE_API_VERSION)
+
+
+def _vm_removed(vm_id):
+    """
+    Check whether a VM for which an identity was recorded has been removed.
+
+    Only a VM whose resource is confirmed to be gone, or to have been
+    replaced by a different VM with the same name, counts as removed.
+    """
+    resource_id = kv().get("charm.azure.vm-resource-ids", {}).get(vm_id)
+    if not resource_id:
+        return False
+    try:
+        vm = _arm_request(
+            "GET", "{}?api-version={}".format(resource_id, COMPUTE_API_VERSION)
+        )
+    except DoesNotExistAzureError:
+        return True
+    except AzureError as e:
+        log_debug("Unable to check if VM {} was removed: {}", vm_id, e)
+        return False
+    return vm["properties"]["vmId"] != vm_id
+
+
+@lru_cache(maxsize=None)
+def _get_vm(vm_id, vm_path):
+    """
+    Get the ARM resource for a VM.
+
+    This is cached for the rest of the hook, so that the requests for a given
+    VM only need to fetch it once.
+    """
+    return _arm_request("GET", vm_path)
+
+
+@lru_cache(maxsize=None)
+def _get_group(resource_group):
+    """
+    Get the ARM resource for a resource group.
+
+    This is cached for the rest of the hook, since most requests will be from
+    VMs in the same resource group.
+    """
+    return _arm_request(
+        "GET",
+        "/subscriptions/{}/resourcegroups/{}?api-version={}".format(
+            kv().get("charm.azure.sub-id"), resource_group, RESOURCES_API_VERSION
+        ),
+    )
+
+
+def _list_vm_ids():
+    """
+    Get the IDs of all of the VMs in the subscription.
+    """
+    vm_ids = set()
+    url = (
+        "{}/subscriptions/{}/providers/Microsoft.Compute/virtualMachines"
+        "?api-version={}".format(
+            ARM_URL, kv().get("charm.azure.sub-id"), COMPUTE_API_VERSION
+        )
+    )
+    while url:
+        page = _arm_send("GET", url)[2]
+        vm_ids.update(vm["properties"]["vmId"] for vm in page["value"])
+        url = page.get("nextLink")
+    return vm_ids
+
+
+def _role_definition_id(sub_id, role_guid):
+    """
+    Get the fully qualified ID of a role definition.
+    """
+    return (
+        "/subscriptions/{}/providers/Microsoft.Authorization"
+        "/roleDefinitions/{}".format(sub_id, role_guid)
+    )
+
+
+def _find_role_definition(sub_id, role_fullname):
+    """
+    Look up the ID of a custom role definition by name.
+    """
+    path = (
+        "/subscriptions/{}/providers/Microsoft.Authorization/roleDefinitions"
+        "?$filter={}&api-version={}".format(
+            sub_id,
+            quote("roleName eq '{}'".format(role_fullname)),
+            AUTHORIZATION_API_VERSION,
+        )
+    )
+    for role in _arm_request("GET", path)["value"]:
+        return role["id"]
+    return None
+
+
+@lru_cache(maxsize=None)
+def _load_role_template(role_name):
+    """
+    Load the custom role definition file for the given short role name.
+
+    The result is shared between callers, so must not be modified.
+    """
+    role_file = Path("files/roles/{}.json".format(role_name))
+    return json.loads(role_file.read_text())
+
+
+@lru_cache(maxsize=None)
+def _role_file_hash(role_name):
+    """
+    Get the SHA-256 of the custom role definition file for the given short
+    role name, so that changes to it can be detected.
+    """
+    role_file = Path("files/roles/{}.json".format(role_name))
+    return hashlib.sha256(role_file.read_bytes()).hexdigest()
+
+
+def _role_cache_key(role_name):
+    """
+    Get the key for caching the ID of a custom role, which is specific to
+    the subscription.
+    """
+    return "{}/{}".format(kv().get("charm.azure.sub-id"), role_name)
+
+
+@lru_cache(maxsize=None)
+def _render_role(role_name, sub_id):
+    """
+    Get the full name and assignable scopes of a custom role for the given
+    subscription.
+    """
+    role_data = _load_role_template(role_name)
+    role_fullname = role_data["Name"].format(sub_id)
+    scopes = tuple(scope.format(sub_id) for scope in role_data["AssignableScopes"])
+    return role_fullname, scopes
+
+
+def _put_role_definition(role_name, sub_id, role_id=None):
+    """
+    Create or update a custom role definition from its role file.
+
+    If no existing role ID is given, a new one is derived from the role name.
+    Returns the ID of the role definition.
+    """
+    role_data = _load_role_template(role_name)
+    role_fullname, scopes = _render_role(role_name, sub_id)
+    if role_id is None:
+        role_id = _role_definition_id(sub_id, uuid5(NAMESPACE_URL, role_fullname))
+        log("Creating role {}", role_fullname)
+    else:
+        log("Updating role {}", role_fullname)
+    properties = {
+        "roleName": role_fullname,
+        "description": role_data["Description"],
+        "type": "CustomRole",
+        "permissions": [
+            {
+                "actions": role_data["Actions"],
+                "notActions": role_data.get("NotActions", []),
+            }
+        ],
+        "assignableScopes": list(scopes),
+    }
+    _arm_request(
+        "PUT",
+        "{}?api-version={}".format(role_id, AUTHORIZATION_API_VERSION),
+        {"properties": properties},
+    )
+    return role_id
+
+
 def _get_nic_from_ip(ip, resource_group):
     """
     Loop over the NICs present and pull out the one
@@ -747,7 +1331,14 @@ def _get_nic_from_ip(ip, resource_group):
     :param resource_group: String resource group to filter by
     """
     nics = json.loads(
-        _azure("network", "nic", "list", "--resource-group", resource_group)
+        _azure(
+            "network",
+            "nic",
+            "list",
+            "--resource-group",
+            resource_group,
+            parse_json=False,
+        )
     )
 
     for nic in nics:
@@ -756,30 +1347,74 @@ def _get_nic_from_ip(ip, resource_group):
                 return conf.get("id")
 
 
+def kv_cached(namespace, key_fn=None, etag_fn=None):
+    """
+    Decorator to cache the results of a function in unitdata, so that they
+    are reused across hooks.
+
+    Results are stored in the given namespace under the key returned by
+    key_fn for the call's arguments (by default, the first argument), along
+    with the value of etag_fn for the arguments, if given. A cached result
+    is used until etag_fn returns something different. None is never cached.
+
+    The decorated function has an invalidate method which takes the same
+    arguments and drops the cached result for them, for when the caller
+    learns that the result is stale.
+    """
+
+    def decorator(func):
+        def cache_key(args):
+            return str(key_fn(*args) if key_fn else args[0])
+
+        @wraps(func)
+        def wrapper(*args):
+            key = cache_key(args)
+            cache = kv().get(namespace, {})
+            entry = cache.get(key)
+            etag = etag_fn(*args) if etag_fn else None
+            if entry and entry["etag"] == etag:
+                return entry["value"]
+            value = func(*args)
+            if value is not None:
+                cache[key] = {"value": value, "etag": etag}
+                kv().set(namespace, cache)
+            return value
+
+        def invalidate(*args):
+            cache = kv().get(namespace, {})
+            if cache.pop(cache_key(args), None) is not None:
+                kv().set(namespace, cache)
+
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
+
+
+@kv_cached("charm.azure.cache.tenant-ids")
 def _get_tenant_id(subscription_id):
     """
     Translate the subscription ID into a tenant ID by making an unauthorized
     request to the API and extracting the tenant ID from the WWW-Authenticate
     header in the error response.
+
+    The result is cached per subscription, since it won't change.
     """
-    url = (
-        "https://management.azure.com/subscriptions/"
-        "{}?api-version=2018-03-01-01.6.1".format(subscription_id)
+    status_code, headers, _ = _https_request(
+        "GET", _TENANT_URL_TMPL.format(subscription_id)
     )
-    try:
-        urlopen(url)
+    if status_code < 400:
         log_err('Error getting tenant ID: did not get "unauthorized" response')
         return None
-    except HTTPError as e:
-        if "WWW-Authenticate" not in e.headers:
-            log_err("Error getting tenant ID: missing WWW-Authenticate header")
-            return None
-        www_auth = e.headers["WWW-Authenticate"]
-        match = re.search(r'authorization_uri="[^"]*/([^/"]*)"', www_auth)
-        if not match:
-            log_err("Error getting tenant ID: unable to find in {}", www_auth)
-            return None
-        return match.group(1)
+    if "WWW-Authenticate" not in headers:
+        log_err("Error getting tenant ID: missing WWW-Authenticate header")
+        return None
+    www_auth = headers["WWW-Authenticate"]
+    match = _AUTH_URI_RE.search(www_auth)
+    if not match:
+        log_err("Error getting tenant ID: unable to find in {}", www_auth)
+        return None
+    return match.group(1)
 
 
 def _get_msi(vm_id):
@@ -790,36 +1425,27 @@ def _get_msi(vm_id):
     return vm_identities.get(vm_id)
 
 
+@kv_cached(
+    "charm.azure.cache.role-ids", key_fn=_role_cache_key, etag_fn=_role_file_hash
+)
 def _get_role(role_name):
     """
-    Translate short role name into a full role name and ensure that the
-    custom role is loaded.
+    Translate short role name into the ID of the custom role and ensure that
+    the custom role is loaded.
 
     The custom roles have to be applied to a specific subscription ID, but
     the subscription ID applies to the entire credential, so will almost
     certainly be reused, so there's not much danger in hitting the 2k
     custom role limit.
+
+    The role is only created or updated again if its definition file has
+    changed since it was last loaded.
     """
-    known_roles = kv().get("charm.azure.roles", {})
-    if role_name in known_roles:
-        return known_roles[role_name]
     sub_id = kv().get("charm.azure.sub-id")
-    role_file = Path("files/roles/{}.json".format(role_name))
-    role_data = json.loads(role_file.read_text())
-    role_fullname = role_data["Name"].format(sub_id)
-    scope = role_data["AssignableScopes"][0].format(sub_id)
-    role_data["Name"] = role_fullname
-    role_data["AssignableScopes"][0] = scope
-    try:
-        log("Ensuring role {}", role_fullname)
-        _azure(
-            "role", "definition", "create", "--role-definition", json.dumps(role_data)
-        )
-    except AlreadyExistsAzureError:
-        pass
-    known_roles[role_name] = role_fullname
-    kv().set("charm.azure.roles", known_roles)
-    return role_fullname
+    role_fullname, _ = _render_role(role_name, sub_id)
+    log("Ensuring role {}", role_fullname)
+    role_id = _find_role_definition(sub_id, role_fullname)
+    return _put_role_definition(role_name, sub_id, role_id)
 
 
 def _get_resource_group():
@@ -837,6 +1463,8 @@ def _get_metadata():
     if cache:
         return cache
     else:
+        from urllib.request import urlopen, Request
+
         r = Request(
             "http://169.254.169.254/metadata/instance?api-version=2017-12-01",
             headers={"Metadata": "true"},
@@ -848,23 +1476,35 @@ def _get_metadata():
 
 
 def _assign_role(request, role, resource_group=None):
+    sub_id = kv().get("charm.azure.sub-id")
     if isinstance(role, StandardRole):
-        role = role.value
+        role = _role_definition_id(sub_id, role.value)
     msi = _get_msi(request.vm_id)
     rg = request.resource_group
     if resource_group is not None:
         rg = resource_group
-    try:
-        _azure(
-            "role",
-            "assignment",
-            "create",
-            "--assignee-object-id",
-            msi,
-            "--resource-group",
-            rg,
-            "--role",
-            role,
+    scope = "/subscriptions/{}/resourceGroups/{}".format(sub_id, rg)
+    # use a stable name so that repeated requests map to the same assignment
+    assignment_name = uuid5(NAMESPACE_URL, "{}/{}/{}".format(scope, role, msi))
+    assignment_id = "{}/providers/Microsoft.Authorization/roleAssignments/{}".format(
+        scope, assignment_name
+    )
+    # track the assignments made for each VM so they can be cleaned up
+    role_assignments = kv().get("charm.azure.role-assignments", {})
+    vm_assignments = role_assignments.setdefault(request.vm_id, [])
+    if assignment_id not in vm_assignments:
+        vm_assignments.append(assignment_id)
+        kv().set("charm.azure.role-assignments", role_assignments)
+    _pending_ops.append(
+        (
+            "PUT",
+            "{}?api-version={}".format(assignment_id, AUTHORIZATION_API_VERSION),
+            {
+                "properties": {
+                    "roleDefinitionId": role,
+                    "principalId": msi,
+                    "principalType": "ServicePrincipal",
+                }
+            },
         )
-    except AlreadyExistsAzureError:
-        pass
+    )
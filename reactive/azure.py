@@ -85,6 +85,7 @@ def handle_requests():
                     request.vm_name, request.unit_name
                 )
             )
+        layer.azure.flush()
         azure.mark_completed()
     except layer.azure.AzureError:
         layer.azure.log_err(format_exc())
@@ -131,8 +132,11 @@ def cleanup():
 
 
 @hook("upgrade-charm")
-def update_roles():
-    layer.azure.update_roles()
+def upgrade_charm():
+    # log in again, so that the credentials needed for the ARM API are
+    # stored, and then update the roles once that's done
+    clear_flag("charm.azure.creds.set")
+    clear_flag("charm.azure.initial-role-update")
 
     lb_consumers = endpoint_from_name("lb-consumers")
     for request in lb_consumers.all_requests:
@@ -1,9 +1,19 @@
+import charms.unit_test
 from charms import layer
 
-from reactive.azure import pre_series_upgrade
+from reactive.azure import pre_series_upgrade, upgrade_charm
 
 
 def test_series_upgrade():
     assert layer.status.blocked.call_count == 0
     pre_series_upgrade()
     assert layer.status.blocked.call_count == 1
+
+
+def test_upgrade_charm_logs_in_again():
+    charms.unit_test.flags.update(
+        {"charm.azure.creds.set", "charm.azure.initial-role-update"}
+    )
+    upgrade_charm()
+    assert "charm.azure.creds.set" not in charms.unit_test.flags
+    assert "charm.azure.initial-role-update" not in charms.unit_test.flags
@@ -0,0 +1,418 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from charms.layer import azure
+
+
+@pytest.fixture(autouse=True)
+def kv():
+    unitdata = azure.kv()
+    unitdata.clear()
+    yield unitdata
+    unitdata.clear()
+
+
+def test_kv_cached():
+    calls = []
+    etags = {"a": 1}
+
+    @azure.kv_cached("test.cache", etag_fn=lambda key: etags.get(key))
+    def double(key):
+        calls.append(key)
+        return key * 2
+
+    assert double("a") == "aa"
+    assert double("a") == "aa"
+    assert calls == ["a"]
+
+    # a changed etag means the cached result is stale
+    etags["a"] = 2
+    assert double("a") == "aa"
+    assert calls == ["a", "a"]
+
+    double.invalidate("a")
+    assert double("a") == "aa"
+    assert calls == ["a", "a", "a"]
+
+    double("b")
+    assert set(azure.kv().get("test.cache")) == {"a", "b"}
+
+
+def test_kv_cached_skips_none():
+    calls = []
+
+    @azure.kv_cached("test.cache", key_fn=lambda x, y: "{}-{}".format(x, y))
+    def lookup(x, y):
+        calls.append((x, y))
+        return None
+
+    assert lookup(1, 2) is None
+    assert lookup(1, 2) is None
+    assert len(calls) == 2
+    assert azure.kv().get("test.cache") is None
+
+
+def test_redactor():
+    redact = azure._redactor(
+        {"abc": "<app-id>", "abc123xyz": "<app-pass>", None: "<tenant-id>"}
+    )
+    assert redact("id abc pass abc123xyz") == "id <app-id> pass <app-pass>"
+    assert azure._redactor({"a.c": "<x>"})("abc a.c") == "abc <x>"
+    assert azure._redactor({None: "<x>"})("unchanged") == "unchanged"
+
+
+def test_parse_credential_output():
+    expected = {"credential": {"attributes": {"application-id": "app"}}}
+    json_output = '{"credential": {"attributes": {"application-id": "app"}}}\n'
+    yaml_output = "credential:\n  attributes:\n    application-id: app\n"
+    assert azure._parse_credential_output(json_output) == expected
+    assert azure._parse_credential_output(yaml_output) == expected
+
+
+def _error(code, message):
+    return {"error": {"code": code, "message": message}}
+
+
+def test_flush(monkeypatch):
+    ops = [
+        ("PUT", "/ok", {}),
+        ("PUT", "/exists", {}),
+        ("DELETE", "/gone", None),
+        ("PUT", "/missing", {}),
+        ("PUT", "/bad", {}),
+    ]
+    responses = [
+        {"httpStatusCode": 201, "content": {}},
+        {
+            "httpStatusCode": 409,
+            "content": _error("RoleAssignmentExists", "It already exists."),
+        },
+        {"httpStatusCode": 404, "content": _error("NotFound", "Not found.")},
+        {"httpStatusCode": 404, "content": _error("NotFound", "Not found.")},
+        {"httpStatusCode": 400, "content": _error("BadRequest", "Bad.")},
+    ]
+    monkeypatch.setattr(azure, "_arm_batch", lambda subrequests: responses)
+    monkeypatch.setattr(azure, "_pending_ops", list(ops))
+    with pytest.raises(azure.AzureError) as e:
+        azure.flush()
+    assert str(e.value).splitlines() == [
+        "PUT /missing: NotFound: Not found.",
+        "PUT /bad: BadRequest: Bad.",
+    ]
+    assert azure._pending_ops == []
+
+
+def test_flush_falls_back_to_parallel(monkeypatch):
+    def batch(subrequests):
+        raise azure.AzureError("batch unavailable")
+
+    sent = []
+
+    def parallel(subrequests):
+        sent.extend(subrequests)
+        return [{"httpStatusCode": 200, "content": None} for _ in subrequests]
+
+    monkeypatch.setattr(azure, "_arm_batch", batch)
+    monkeypatch.setattr(azure, "_arm_parallel", parallel)
+    monkeypatch.setattr(azure, "_pending_ops", [("PUT", "/ok", {})])
+    azure.flush()
+    assert sent == [("PUT", "/ok", {})]
+
+
+def test_arm_batch_matches_responses_by_name(monkeypatch):
+    def send(method, url, body=None):
+        names = [subrequest["name"] for subrequest in body["requests"]]
+        return 200, {}, {
+            "responses": [
+                {"name": name, "httpStatusCode": 200, "content": name}
+                for name in reversed(names)
+            ]
+        }
+
+    monkeypatch.setattr(azure, "_arm_send", send)
+    responses = azure._arm_batch([("GET", "/a", None), ("GET", "/b", None)])
+    assert [r["content"] for r in responses] == ["0", "1"]
+
+
+@pytest.mark.parametrize(
+    "result",
+    [
+        {"responses": []},
+        {"responses": [{"httpStatusCode": 200}]},
+        {"error": _error("Oops", "Oops.")},
+    ],
+)
+def test_arm_batch_incomplete_response(monkeypatch, result):
+    monkeypatch.setattr(azure, "_arm_send", lambda *args, **kwargs: (200, {}, result))
+    with pytest.raises(azure.AzureError):
+        azure._arm_batch([("GET", "/a", None)])
+
+
+@pytest.fixture
+def vms(kv, monkeypatch):
+    """
+    Record identities for VMs which are still listed, unlisted but still
+    present, gone, replaced, or were never given a resource ID.
+    """
+    vm_ids = ["listed", "unlisted", "gone", "replaced", "unknown"]
+    kv.set("charm.azure.vm-identities", {vm_id: "msi-" + vm_id for vm_id in vm_ids})
+    kv.set(
+        "charm.azure.vm-resource-ids",
+        {vm_id: "/vms/" + vm_id for vm_id in vm_ids if vm_id != "unknown"},
+    )
+    kv.set(
+        "charm.azure.role-assignments",
+        {vm_id: ["/assignments/" + vm_id] for vm_id in vm_ids},
+    )
+
+    def arm_request(method, path, body=None):
+        vm_id = path.split("?")[0].split("/")[-1]
+        if vm_id == "gone":
+            raise azure.DoesNotExistAzureError("NotFound: Not found.")
+        if vm_id == "replaced":
+            return {"properties": {"vmId": "new-vm"}}
+        return {"properties": {"vmId": vm_id}}
+
+    monkeypatch.setattr(azure, "_list_vm_ids", lambda: {"listed"})
+    monkeypatch.setattr(azure, "_arm_request", arm_request)
+    monkeypatch.setattr(azure, "_pending_ops", [])
+    return vm_ids
+
+
+def test_cleanup(kv, vms, monkeypatch):
+    sent = []
+
+    def batch(subrequests):
+        sent.extend(subrequests)
+        return [{"httpStatusCode": 200, "content": None} for _ in subrequests]
+
+    monkeypatch.setattr(azure, "_arm_batch", batch)
+    azure.cleanup()
+    kept = ["listed", "unlisted", "unknown"]
+    assert set(kv.get("charm.azure.vm-identities")) == set(kept)
+    assert set(kv.get("charm.azure.vm-resource-ids")) == {"listed", "unlisted"}
+    assert set(kv.get("charm.azure.role-assignments")) == set(kept)
+    assert sorted(sent) == [
+        (
+            "DELETE",
+            "/assignments/{}?api-version={}".format(
+                vm_id, azure.AUTHORIZATION_API_VERSION
+            ),
+            None,
+        )
+        for vm_id in ["gone", "replaced"]
+    ]
+
+    # nothing is checked again until the interval has passed
+    listed = []
+    monkeypatch.setattr(azure, "_list_vm_ids", lambda: listed.append(1) or set())
+    azure.cleanup()
+    assert listed == []
+    kv.set("charm.azure.last-cleanup", time.time() - azure.CLEANUP_INTERVAL)
+    azure.cleanup()
+    assert listed == [1]
+
+
+def test_cleanup_failed_flush(kv, vms, monkeypatch):
+    def batch(subrequests):
+        return [
+            {"httpStatusCode": 400, "content": _error("BadRequest", "Bad.")}
+            for _ in subrequests
+        ]
+
+    monkeypatch.setattr(azure, "_arm_batch", batch)
+    keys = [
+        "charm.azure.vm-identities",
+        "charm.azure.vm-resource-ids",
+        "charm.azure.role-assignments",
+    ]
+    before = {key: kv.get(key) for key in keys}
+    azure.cleanup()
+    assert {key: kv.get(key) for key in keys} == before
+
+
+def test_get_arm_token(kv, monkeypatch):
+    now = 1000
+    tokens = []
+
+    def https_request(method, url, data=None, headers=None):
+        tokens.append("token-{}".format(len(tokens)))
+        content = {"access_token": tokens[-1], "expires_in": 3600}
+        return 200, {}, json.dumps(content).encode("utf8")
+
+    kv.set(
+        "charm.azure.creds",
+        {"application-id": "app", "application-password": "pass", "tenant-id": "t"},
+    )
+    monkeypatch.setattr(azure, "_https_request", https_request)
+    monkeypatch.setattr(azure.time, "time", lambda: now)
+    assert azure._get_arm_token() == "token-0"
+    now += 3600 - 61
+    assert azure._get_arm_token() == "token-0"
+    # a token which is about to expire is refreshed
+    now += 1
+    assert azure._get_arm_token() == "token-1"
+    assert kv.get("charm.azure.arm-token") == {"token": "token-1", "exp": now + 3600}
+
+
+@pytest.fixture
+def request_vm(kv, monkeypatch):
+    """
+    Set up a request from a VM, and its current state in ARM.
+    """
+    kv.set("charm.azure.sub-id", "sub")
+    request = SimpleNamespace(
+        vm_id="vm-id",
+        vm_name="vm",
+        resource_group="rg",
+        instance_tags={"new": "tag"},
+    )
+    vm = {"tags": {"old": "tag"}}
+    monkeypatch.setattr(azure, "_arm_request", lambda method, path, body=None: vm)
+    monkeypatch.setattr(azure, "_pending_ops", [])
+    azure._get_vm.cache_clear()
+    yield request, vm
+    azure._get_vm.cache_clear()
+
+
+def test_tag_instance(request_vm):
+    request, _ = request_vm
+    azure.tag_instance(request)
+    assert azure._pending_ops == [
+        ("PATCH", azure._vm_path(request), {"tags": {"old": "tag", "new": "tag"}})
+    ]
+
+
+def test_ensure_msi_keeps_user_assigned_identities(kv, request_vm, monkeypatch):
+    request, vm = request_vm
+    vm["identity"] = {
+        "type": "UserAssigned",
+        "userAssignedIdentities": {"/identities/uai": {"principalId": "uai-msi"}},
+    }
+    patches = []
+
+    def arm_send(method, url, body=None):
+        patches.append(body)
+        return 202, {}, {"identity": {"principalId": "msi"}}
+
+    monkeypatch.setattr(azure, "_arm_send", arm_send)
+    monkeypatch.setattr(azure, "_wait_for_operation", lambda headers: None)
+    azure.ensure_msi(request)
+    assert patches == [
+        {
+            "identity": {
+                "type": "SystemAssigned, UserAssigned",
+                "userAssignedIdentities": {"/identities/uai": {}},
+            }
+        }
+    ]
+    assert kv.get("charm.azure.vm-identities") == {"vm-id": "msi"}
+    assert kv.get("charm.azure.vm-resource-ids") == {
+        "vm-id": azure._vm_resource_id(request)
+    }
+
+
+def test_assign_role(kv, request_vm):
+    request, _ = request_vm
+    kv.set("charm.azure.vm-identities", {"vm-id": "msi"})
+    azure._assign_role(request, azure.StandardRole.NETWORK_MANAGER)
+    azure._assign_role(request, azure.StandardRole.NETWORK_MANAGER)
+    (assignment_id,) = kv.get("charm.azure.role-assignments")["vm-id"]
+    assert assignment_id.startswith(
+        "/subscriptions/sub/resourceGroups/rg"
+        "/providers/Microsoft.Authorization/roleAssignments/"
+    )
+    assert [op[1] for op in azure._pending_ops] == [
+        "{}?api-version={}".format(assignment_id, azure.AUTHORIZATION_API_VERSION)
+    ] * 2
+    assert azure._pending_ops[0][2]["properties"]["principalId"] == "msi"
+
+
+def test_ensure_msi_uses_existing_identity(kv, request_vm, monkeypatch):
+    request, vm = request_vm
+    vm["identity"] = {"type": "SystemAssigned", "principalId": "msi"}
+
+    def arm_send(method, url, body=None):
+        raise AssertionError("unexpected {} {}".format(method, url))
+
+    monkeypatch.setattr(azure, "_arm_send", arm_send)
+    azure.ensure_msi(request)
+    assert kv.get("charm.azure.vm-identities") == {"vm-id": "msi"}
+
+
+@pytest.fixture
+def creds(kv, monkeypatch):
+    """
+    Set up credentials whose tenant is already known, and record the commands
+    run with the Azure CLI.
+    """
+    kv.set("charm.azure.cache.tenant-ids", {"sub": {"value": "tenant", "etag": None}})
+    commands = []
+
+    def _azure(cmd, *args, return_stderr=False, parse_json=True):
+        commands.append(cmd)
+
+    monkeypatch.setattr(azure, "_azure", _azure)
+    creds_data = {
+        "application-id": "app",
+        "application-password": "pass",
+        "subscription-id": "sub",
+    }
+    return creds_data, commands
+
+
+def test_ensure_login_reuses_login(kv, creds, monkeypatch):
+    creds_data, commands = creds
+    kv.set("charm.azure.creds-hash", azure._creds_hash(creds_data))
+    monkeypatch.setattr(azure, "_get_arm_token", lambda: "token")
+    azure._ensure_login(creds_data)
+    assert commands == []
+
+
+def test_ensure_login_without_token(kv, creds, monkeypatch):
+    creds_data, commands = creds
+    kv.set("charm.azure.creds-hash", azure._creds_hash(creds_data))
+
+    def get_arm_token():
+        raise azure.AzureError("Unable to get ARM token: expired")
+
+    monkeypatch.setattr(azure, "_get_arm_token", get_arm_token)
+    azure._ensure_login(creds_data)
+    assert commands == ["logout", "login"]
+
+
+def test_ensure_login_changed_creds(kv, creds):
+    creds_data, commands = creds
+    kv.set("charm.azure.creds-hash", "old")
+    kv.set("charm.azure.arm-token", {"token": "old", "exp": time.time() + 3600})
+    azure._ensure_login(creds_data)
+    assert commands == ["logout", "login"]
+    assert kv.get("charm.azure.arm-token") is None
+    assert kv.get("charm.azure.creds-hash") == azure._creds_hash(creds_data)
+    assert kv.get("charm.azure.creds") == {
+        "application-id": "app",
+        "application-password": "pass",
+        "tenant-id": "tenant",
+    }
+
+
+def test_login_cli_invalidates_tenant(kv, creds, monkeypatch):
+    creds_data, _ = creds
+
+    def _azure(cmd, *args, return_stderr=False, parse_json=True):
+        if cmd == "login":
+            raise azure.AzureError(
+                "AADSTS70002: app not found in tenant for app with pass"
+            )
+
+    monkeypatch.setattr(azure, "_azure", _azure)
+    with pytest.raises(azure.AzureError) as e:
+        azure.login_cli(creds_data)
+    assert str(e.value) == (
+        "AADSTS70002: <app-id> not found in <tenant-id> for <app-id> with <app-pass>"
+    )
+    assert kv.get("charm.azure.cache.tenant-ids") == {}
+    assert kv.get("charm.azure.creds-hash") is None